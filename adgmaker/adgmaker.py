@@ -1,29 +1,68 @@
 # ADGMaker
 
 import argparse
-import binascii
-import gzip
+import contextlib
+import itertools
 import os
 import platform
-import shutil
-from pathlib import Path
+import zlib
 
-import pkg_resources
-from jinja2 import Environment, FileSystemLoader
+# Escapes text for use inside a double-quoted XML attribute.
+_ATTR_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'})
+
+# Templates precompiled by setup.py, and the zip member recording which jinja2
+# version compiled them.
+_COMPILED_TEMPLATES = '_compiled_templates.zip'
+_COMPILED_JINJA2_VERSION = 'jinja2_version.txt'
 
 
 class ADGMaker(object):
 
     def __init__(self, debug=False, file_type="wav"):
+        # Imported here so that --help and --version don't pay for jinja2.
+        import jinja2
+        from jinja2 import ChoiceLoader, Environment, FileSystemBytecodeCache, FileSystemLoader, ModuleLoader
+
         self.file_type = file_type
         self.debug = debug
 
-        # Ex: {'cello_05_forte_arco-normal': [ xml, xml, .. ]
+        # Ex: {'cello_05_forte_arco-normal': [ xml, xml, .. ], with each xml as UTF-8 bytes
         self.adgs = {}
         self.default_note = 104
 
-        self.jenv = Environment(loader=FileSystemLoader(os.path.dirname(os.path.realpath(__file__))),
-                                trim_blocks=True)
+        # Prefer the templates precompiled by setup.py's build step; fall back
+        # to the .tpl sources, whose bytecode is kept in Jinja's per-user temp
+        # cache dir so later runs can skip parsing them.
+        package_dir = os.path.dirname(os.path.realpath(__file__))
+        compiled = _compiled_templates(package_dir, jinja2.__version__)
+        if compiled is not None:
+            loader = ChoiceLoader([ModuleLoader(compiled), FileSystemLoader(package_dir)])
+            bytecode_cache = None
+        else:
+            loader = FileSystemLoader(package_dir)
+            try:
+                bytecode_cache = FileSystemBytecodeCache(pattern='__adgmaker_%s.cache')
+            except (OSError, RuntimeError):
+                # No safe temp cache dir; just parse the templates every run.
+                bytecode_cache = None
+        self.jenv = Environment(loader=loader,
+                                trim_blocks=True,
+                                bytecode_cache=bytecode_cache)
+        self._instrument_tpl = self.jenv.get_template('instrument_xml.tpl')
+        self._base_tpl = self.jenv.get_template('base_xml.tpl')
+        self._base_head, self._base_sep, self._base_tail = self._split_base_template()
+
+    def _split_base_template(self):
+        """
+        Render the base template once around two markers and return the
+        encoded text before, between and after the items.
+        """
+        first, second = '\x00ITEM0\x00', '\x00ITEM1\x00'
+        xml = self._base_tpl.render(items=[first, second])
+        head, rest = xml.split(first)
+        sep, tail = rest.split(second)
+
+        return head.encode('utf-8'), sep.encode('utf-8'), tail.encode('utf-8')
 
     def empty_adgs(self):
         self.adgs = {}
@@ -34,88 +73,125 @@ class ADGMaker(object):
     def add_sample_file_to_instrument(self, file_path, adg_name, note_value):
 
         instrument_xml = self.create_instrument_xml(file_path, note_value)
+        self.adgs.setdefault(adg_name, []).append(instrument_xml.encode('utf-8'))
 
-        if adg_name in self.adgs:
-            adg_contents = self.adgs[adg_name]
-        else:
-            adg_contents = []
-
-        adg_contents.append(instrument_xml)
-        self.adgs[adg_name] = adg_contents
+    def add_samples_batch(self, adg_name, items):
+        """
+        Add several (file_path, note_value) pairs to one ADG.
+        """
 
-        return
+        adg_contents = self.adgs.setdefault(adg_name, [])
+        adg_contents.extend(self.create_instrument_xml(file_path, note_value).encode('utf-8')
+                            for file_path, note_value in items)
 
     def create_base_xml(self, adg_name):
         """
         Create the standard cruft XML for the ADG.
+
+        Returns an iterator of UTF-8 encoded XML chunks rather than one string,
+        so the full document never has to be held in memory at once.
         """
 
         items = self.adgs[adg_name]
-        xml = self.jenv.get_template('base_xml.tpl').render(
-            items=items,
-        )
+        if not items:
+            return iter([self._base_tpl.render(items=items).encode('utf-8')])
 
-        return xml
+        return self._iter_base_xml(items)
+
+    def _iter_base_xml(self, items):
+        yield self._base_head
+        yield items[0]
+        for item in items[1:]:
+            yield self._base_sep
+            yield item
+        yield self._base_tail
 
     def create_instrument_xml(self, file_path, note_value):
 
         dot_file_type = '.' + self.file_type
 
-        name = file_path.split(dot_file_type)[0].split(os.sep)[-1]
+        name = os.path.splitext(os.path.basename(file_path))[0]
         file_name = name + dot_file_type
-        ableton_path = "userfolder:" + file_path.rsplit(os.sep, 1)[0] + os.sep + '#' + file_name
+        ableton_path = "userfolder:" + os.path.dirname(file_path) + os.sep + '#' + file_name
 
         path_hint_els = self.crate_path_hint(file_path)
 
-        data = binascii.hexlify(file_path.encode('utf-16')).decode('utf-8').upper()
+        # Live stores the path as little-endian UTF-16 with a BOM.
+        data = 'FFFE' + file_path.encode('utf-16-le').hex().upper()
 
-        xml = self.jenv.get_template('instrument_xml.tpl').render(
+        xml = self._instrument_tpl.render(
             path_hint_els=path_hint_els,
-            name=name,
-            sample_file_name=file_name,
+            name=name.translate(_ATTR_ESCAPES),
+            sample_file_name=file_name.translate(_ATTR_ESCAPES),
             note_value=note_value,
-            ableton_path=ableton_path,
+            ableton_path=ableton_path.translate(_ATTR_ESCAPES),
             data=data
         )
 
         return xml
 
     def crate_path_hint(self, file_path):
-        hint_els = []
-        for part in file_path.rsplit(os.sep)[1:-1]:
-            hint_els.append('<RelativePathElement Dir="%s" />' % part)
-
-        return '\n'.join(hint_els)
+        parts = file_path.split(os.sep)[1:-1]
+        return '\n'.join(f'<RelativePathElement Dir="{part.translate(_ATTR_ESCAPES)}" />' for part in parts)
 
     def create_adg(self, adg_name, xml):
         """
         Create the final ADG file.
+
+        `xml` is either a string, bytes, or an iterable of str/bytes chunks.
         """
 
-        xml_name = adg_name + '.xml'
         adg_file = adg_name + '.adg'
+        chunks = (xml,) if isinstance(xml, (str, bytes)) else xml
 
-        f = open(xml_name, 'w')
-        f.write(xml)
-        f.close()
-
-        with open(xml_name, 'rb') as f_in:
-            with gzip.open(adg_file, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+        # wbits=16+15 makes zlib emit a gzip container, which is what Live reads.
+        compressor = zlib.compressobj(level=1, wbits=16 + zlib.MAX_WBITS)
 
-        if not self.debug:
-            os.remove(xml_name)
+        # The XML is only kept on disk for debugging.
+        xml_file = open(adg_name + '.xml', 'wb') if self.debug else contextlib.nullcontext()
+        with xml_file as xml_out, open(adg_file, 'wb', buffering=256 * 1024) as f_out:
+            for chunk in chunks:
+                data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                if xml_out is not None:
+                    xml_out.write(data)
+                f_out.write(compressor.compress(data))
+            f_out.write(compressor.flush())
 
         print("Created " + adg_file)
 
         return adg_file
 
 
+def _compiled_templates(package_dir, jinja2_version):
+    """
+    Return the path of the precompiled templates, or None if they are missing
+    or were compiled by a different jinja2 than the one running.
+    """
+    import zipfile
+
+    path = os.path.join(package_dir, _COMPILED_TEMPLATES)
+    try:
+        with zipfile.ZipFile(path) as zf:
+            built_with = zf.read(_COMPILED_JINJA2_VERSION).decode('utf-8')
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return None
+
+    return path if built_with == jinja2_version else None
+
+
 class SamplePackAdgMaker:
 
-    def __init__(self, file_type="wav"):
+    def __init__(self, file_type="wav", debug=False):
         self.file_type = file_type
-        self.adg_maker = ADGMaker(file_type=file_type)
+        self.debug = debug
+        self._adg_maker = None
+
+    @property
+    def adg_maker(self):
+        # Built on first use, so argument parsing doesn't load the templates.
+        if self._adg_maker is None:
+            self._adg_maker = ADGMaker(debug=self.debug, file_type=self.file_type)
+        return self._adg_maker
 
     def handle(self, argv=None):
         """
@@ -141,6 +217,7 @@ class SamplePackAdgMaker:
         print(self.vargs)
 
         if self.vargs['version']:
+            import pkg_resources
             version = pkg_resources.require("adgmaker")[0].version
             print(version)
             return
@@ -156,36 +233,103 @@ class SamplePackAdgMaker:
         print("Done! Remember to update your User Library in Live to see these new instruments!")
 
     def get_subdirs_containing_valid_samples(self, path, include_loops=False):
-        return [p for p in Path(path).iterdir() if
-                p.is_dir() and (include_loops is True or (include_loops is False and 'loop' not in p.name.lower()))]
+        with os.scandir(path) as it:
+            return [e for e in it if
+                    e.is_dir() and (include_loops is True or (include_loops is False and 'loop' not in e.name.lower()))]
+
+    def _scan_samples(self, root, suffix):
+        """
+        Lazily yield paths of files ending in `suffix` below `root`.
+
+        Walks with os.scandir so directory entries reuse the type information
+        from readdir. Nothing is read past the entries the caller consumes.
+        """
+        stack = [root]
+        while stack:
+            subdirs = []
+            try:
+                it = os.scandir(stack.pop())
+            except PermissionError:
+                # Unreadable directories are skipped, as rglob does.
+                continue
+            with it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.name.endswith(suffix) and entry.is_file():
+                        yield entry.path
+            # Visit subdirectories in listing order, as rglob does.
+            stack.extend(reversed(subdirs))
 
     def create_adg_from_samples_path(self, samples_path, given_name=None, include_loops=False):
         """
         Create an ADG from the samples path.
 
+        Each ADG is written to disk as soon as it is built and is not kept in
+        adg_maker.all_adgs(), whether it was built here or in a worker process.
         """
-        file_type_wildcard = f'*.{self.file_type}'
+        dot_file_type = '.' + self.file_type
+
+        # Resolve once; every subdir and sample path is built from this.
+        samples_path = os.path.abspath(samples_path)
 
         if given_name is None:
-            given_name = Path(samples_path).parts[-1]
+            given_name = os.path.basename(samples_path)
 
         subdirs = self.get_subdirs_containing_valid_samples(samples_path, include_loops)
 
+        jobs = []
         for subdir in subdirs:
 
             adg_name = f'{given_name} - {subdir.name}'
 
-            samples_list = list(Path(subdir).rglob(file_type_wildcard))[0:104]
+            samples_list = list(itertools.islice(
+                self._scan_samples(subdir.path, dot_file_type), 104))
+            if not samples_list:
+                continue
+
+            items = [(file_path, 104 - i) for i, file_path in enumerate(samples_list)]
+            jobs.append((adg_name, items))
+
+        if len(jobs) <= 1:
+            for adg_name, items in jobs:
+                _build_adg(self.adg_maker, adg_name, items)
+            return
+
+        # Each ADG is independent, so render and compress them in parallel.
+        import concurrent.futures
+
+        workers = min(len(jobs), os.cpu_count() or 1)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                    initargs=(self.file_type, self.debug)) as executor:
+            futures = [executor.submit(_build_adg_in_worker, adg_name, items) for adg_name, items in jobs]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
+
+def _build_adg(adg_maker, adg_name, items):
+    """
+    Render and write a single ADG, then drop it from the maker.
+    """
+    adg_maker.add_samples_batch(adg_name, items)
+    final_xml = adg_maker.create_base_xml(adg_name)
+    adg_file = adg_maker.create_adg(adg_name, final_xml)
+    del adg_maker.adgs[adg_name]
+
+    return adg_file
+
+
+# The ADGMaker of the current worker process, shared by all of its jobs.
+_worker_adg_maker = None
+
 
-            for i, sample_file in enumerate(samples_list):
-                file_path = os.path.abspath(sample_file)
+def _init_worker(file_type, debug):
+    global _worker_adg_maker
+    _worker_adg_maker = ADGMaker(debug=debug, file_type=file_type)
 
-                note_value = 104 - i
-                self.adg_maker.add_sample_file_to_instrument(file_path, adg_name, note_value)
 
-        for adg_name in self.adg_maker.all_adgs():  # self.adgs.keys():
-            final_xml = self.adg_maker.create_base_xml(adg_name)
-            self.adg_maker.create_adg(adg_name, final_xml)
+def _build_adg_in_worker(adg_name, items):
+    return _build_adg(_worker_adg_maker, adg_name, items)
 
 
 if __name__ == '__main__':  # pragma: no cover
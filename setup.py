@@ -1,6 +1,8 @@
 import os
 import sys
+import zipfile
 from setuptools import setup
+from setuptools.command.build_py import build_py
 
 # Set external files
 try:
@@ -12,12 +14,42 @@ except ImportError:
 with open(os.path.join(os.path.dirname(__file__), 'requirements.txt')) as f:
     required = f.read().splitlines()
 
+
+class BuildPyWithTemplates(build_py):
+    """
+    Also compile the Jinja templates ahead of time into the built package.
+    """
+
+    def run(self):
+        build_py.run(self)
+
+        try:
+            import jinja2
+            from jinja2 import Environment, FileSystemLoader
+        except ImportError:
+            # Templates will be compiled at runtime instead.
+            self.warn('jinja2 is not installed; skipping template precompilation')
+            return
+
+        # Must match the Environment options used in adgmaker.ADGMaker.
+        env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'adgmaker')),
+                          trim_blocks=True)
+        target = os.path.join(self.build_lib, 'adgmaker', '_compiled_templates.zip')
+        env.compile_templates(target, zip='stored', filter_func=lambda name: name.endswith('.tpl'))
+
+        # Compiled templates only work with the jinja2 that built them; ADGMaker
+        # checks this marker and ignores the zip on a mismatch.
+        with zipfile.ZipFile(target, 'a') as zf:
+            zf.writestr('jinja2_version.txt', jinja2.__version__)
+
+
 setup(
     name='adgmaker',
     version='0.1.3',
     packages=['adgmaker'],
     install_requires=required,
     test_suite='nose.collector',
+    cmdclass={'build_py': BuildPyWithTemplates},
     include_package_data=True,
     license='MIT License',
     description='Create Free Ableton Live Instruments from Philharmonic Samples',